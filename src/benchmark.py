@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+"""benchmark.py
+
+Benchmarks of the porting hot paths on synthetic data.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import nicofox2bookmarks
+
+# Startup budgets of the entry points, in microseconds of cumulative import time (-X importtime).
+# Importing everything eagerly took about 40 ms for nicofox2bookmarks and 14 ms for jsonlz4_decoder.
+IMPORT_TIME_BUDGETS = {
+    'nicofox2bookmarks': 25000,
+    'jsonlz4_decoder': 5000,
+    'bookmarks_diff': 25000,
+    }
+# Modules which must be loaded only on the code paths that need them: argparse, the helpers for
+# default filenames (and their configparser and pathlib), jsonlz4 input and spilling (and its tempfile),
+# the optional 3rd-party backends and the process pool.
+LAZY_MODULES = (
+    'argparse', 'concurrent.futures', 'configparser', 'firefox_helper', 'jsonlz4_decoder', 'lz4', 'orjson',
+    'pathlib', 'platform', 'spilling', 'tempfile', 'ujson')
+
+def _make_bookmarks(count):
+    bookmarks = []
+    for number in range(count):
+        bookmark = nicofox2bookmarks._create_bookmark_data()
+        bookmark['title'] = 'Video title {}'.format(number)
+        bookmark['url'] = 'http://www.nicovideo.jp/watch/sm{}'.format(number)
+        bookmark['description'] = 'Description {}'.format(number) if number % 3 else ''
+        bookmark['add_time'] = nicofox2bookmarks.nicofox_time_to_bookmark_time(1262304000000 + number * 1000)
+        if number % 10 == 0:
+            bookmark['tags'] = ['Music', 'NicoFox']
+        bookmarks.append(bookmark)
+    return bookmarks
+
+def bench_export_loop(rows, common_tags=('NicoFox', 'Niconico', 'Video')):
+    """Measure building the bookmark items of the export loop, return time and memory per row."""
+    meta_data = nicofox2bookmarks.create_metadata()
+    meta_data['common_tags'] = list(common_tags)
+    bookmarks = _make_bookmarks(rows)
+    best = None
+    for _ in range(3):
+        container = {'children': []}
+        start = time.perf_counter()
+        nicofox2bookmarks.bj_append_bookmarks(container, bookmarks, meta_data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    del container
+    tracemalloc.start()
+    container = {'children': []}
+    nicofox2bookmarks.bj_append_bookmarks(container, bookmarks, meta_data)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'ns_per_row': best * 1e9 / rows,
+        'retained_bytes_per_row': retained / rows,
+        'peak_bytes_per_row': peak / rows,
+        }
+
+def measure_import_time(module, repeat=5):
+    """Import the module in fresh interpreters, return the best import time (us) and the loaded modules."""
+    code = 'import sys, {}; print(" ".join(sys.modules))'.format(module)
+    command = [sys.executable, '-X', 'importtime', '-c', code]
+    directory = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ)
+    environment.pop('PYTHONDONTWRITEBYTECODE', None) # Measure with the bytecode cache, as installed.
+    subprocess.run(command, cwd=directory, env=environment, capture_output=True, check=True) # Warm up the cache.
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(command, cwd=directory, env=environment, capture_output=True, check=True, text=True)
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module and fields[2].startswith(' ' + module):
+                elapsed = int(fields[1])
+                best = elapsed if best is None else min(best, elapsed)
+        loaded = set(result.stdout.split())
+    return best, loaded
+
+def check_import_time(budgets=None):
+    """Check the startup of entry points against their budgets, return a list of (module, time, problems)."""
+    results = []
+    for module, budget in (budgets or IMPORT_TIME_BUDGETS).items():
+        elapsed, loaded = measure_import_time(module)
+        problems = []
+        if elapsed > budget:
+            problems.append('over budget ({} us)'.format(budget))
+        eager = sorted(name for name in LAZY_MODULES if name in loaded and name != module)
+        if eager:
+            problems.append('eagerly imports {}'.format(', '.join(eager)))
+        results.append((module, elapsed, problems))
+    return results
+
+def _parse_arguments(args=None):
+    """Setup and parse program arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000, help='The number of synthetic NicoFox items.')
+    return parser.parse_args(args)
+
+def main():
+    """Main function."""
+    arguments = _parse_arguments()
+    failed = False
+    print('Import time:')
+    for module, elapsed, problems in check_import_time():
+        print('  {}: {} us{}'.format(module, elapsed, ''.join('; ' + problem for problem in problems)))
+        failed = failed or bool(problems)
+    result = bench_export_loop(arguments.rows)
+    print('Export loop ({} rows):'.format(arguments.rows))
+    print('  {:.0f} ns/row'.format(result['ns_per_row']))
+    print('  {:.0f} bytes/row retained, {:.0f} bytes/row peak'.format(
+        result['retained_bytes_per_row'], result['peak_bytes_per_row']))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
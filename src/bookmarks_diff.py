@@ -0,0 +1,243 @@
+# -*- coding: UTF-8 -*-
+"""bookmarks_diff.py
+
+Structural diff between two Firefox bookmarks backups, and patching a backup with it.
+Nodes are matched by GUID, or by URI (by title in the parent for folders) when they have no GUID.
+A patch only carries the removed, added, moved and changed nodes, and the new order of
+the containers whose children differ, so syncing a backup only rewrites the delta.
+"""
+import functools
+import gc
+import os
+
+import json_backend
+import nicofox2bookmarks
+
+PATCH_VERSION = 1
+_NODE_KEYS_IGNORED = ('children', 'index') # Children and positions are carried by 'order'.
+
+def create_patch():
+    """Create an empty patch."""
+    return {
+        'version': PATCH_VERSION,
+        'removed': [], # Keys of the top nodes of removed subtrees.
+        'added': [], # {'key', 'parent', 'node'} in tree order, nodes without children.
+        'moved': [], # {'key', 'parent'} of nodes which change their parent or relative order.
+        'changed': [], # {'key', 'set', 'unset'} of nodes whose attributes differ.
+        'order': {}, # Parent key -> child keys, for the containers whose children differ.
+        }
+
+def _without_gc(function):
+    # Indexing allocates lots of acyclic tuples and lists, and each collection would walk the loaded trees.
+    @functools.wraps(function)
+    def _wrapper(*args, **kwargs):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if enabled:
+                gc.enable()
+    return _wrapper
+
+def _make_key(node, parent_key, occurrences):
+    guid = node.get('guid')
+    if guid is not None:
+        return guid
+    uri = node.get('uri')
+    if uri is not None:
+        key = 'uri:' + uri
+    else:
+        key = 'path:{}/{}'.format(parent_key, node.get('title', ''))
+    # Tell duplicated nodes apart by the order they appear.
+    count = occurrences.get(key, 0)
+    occurrences[key] = count + 1
+    return key if count == 0 else '{}#{}'.format(key, count)
+
+def index_tree(bookmarks_json):
+    """Walk the whole tree once and return a dictionary of key -> (node, parent key, child keys).
+
+    The dictionary is in tree order (parents before their children).
+    """
+    root_key = bookmarks_json.get('guid')
+    if root_key is None:
+        raise ValueError('the root of bookmarks has no GUID.')
+    index = {}
+    occurrences = {}
+    pending = [(bookmarks_json, root_key, None)]
+    while pending:
+        node, key, parent_key = pending.pop()
+        children = node.get('children')
+        child_keys = [_make_key(child, key, occurrences) for child in children] if children else []
+        index[key] = (node, parent_key, child_keys)
+        pending.extend(reversed([(child, child_key, key) for child, child_key in zip(children or (), child_keys)]))
+    return index
+
+def _copy_node(node):
+    copied = dict(node) # Keep 'index' so that attributes stay in the original order.
+    if 'children' in copied:
+        copied['children'] = []
+    return copied
+
+def _diff_attributes(old_node, new_node):
+    changed = {}
+    for name, value in new_node.items():
+        if name not in _NODE_KEYS_IGNORED and (name not in old_node or old_node[name] != value):
+            changed[name] = value
+    unset = [name for name in old_node if name not in new_node and name not in _NODE_KEYS_IGNORED]
+    return changed, unset
+
+@_without_gc
+def diff_bookmarks(old_json, new_json):
+    """Compare two bookmarks trees and return the patch which turns the old one into the new one."""
+    old_index = index_tree(old_json)
+    new_index = index_tree(new_json)
+    patch = create_patch()
+    for key, (_, parent_key, _) in old_index.items():
+        if key not in new_index and (parent_key is None or parent_key in new_index):
+            patch['removed'].append(key)
+    for key, (new_node, parent_key, child_keys) in new_index.items():
+        old_entry = old_index.get(key)
+        if old_entry is None:
+            patch['added'].append({'key': key, 'parent': parent_key, 'node': _copy_node(new_node)})
+            if 'children' in new_node:
+                patch['order'][key] = child_keys
+            continue
+        old_node, old_parent_key, old_child_keys = old_entry
+        if parent_key != old_parent_key:
+            patch['moved'].append({'key': key, 'parent': parent_key})
+        changed, unset = _diff_attributes(old_node, new_node)
+        if changed or unset:
+            change = {'key': key}
+            if changed:
+                change['set'] = changed
+            if unset:
+                change['unset'] = unset
+            patch['changed'].append(change)
+        if child_keys == old_child_keys:
+            continue
+        patch['order'][key] = child_keys
+        # The children which stay in this container but change their relative order are moved too.
+        old_staying = [child_key for child_key in old_child_keys
+                       if child_key in new_index and new_index[child_key][1] == key]
+        new_staying = [child_key for child_key in child_keys
+                       if child_key in old_index and old_index[child_key][1] == key]
+        patch['moved'].extend({'key': new_key, 'parent': key}
+                              for old_key, new_key in zip(old_staying, new_staying) if old_key != new_key)
+    return patch
+
+@_without_gc
+def apply_patch(bookmarks_json, patch):
+    """Apply the patch to the bookmarks tree in place and return the tree.
+
+    Only the containers listed in the patch are rebuilt, the rest of the tree is left untouched.
+    """
+    if patch.get('version') != PATCH_VERSION:
+        raise ValueError('unsupported patch version: {!r}.'.format(patch.get('version')))
+    index = index_tree(bookmarks_json)
+    nodes = {key: entry[0] for key, entry in index.items()}
+    keys = {id(node): key for key, node in nodes.items()}
+
+    def _get_node(key):
+        node = nodes.get(key)
+        if node is None:
+            raise ValueError('the patch does not match the bookmarks, node {!r} is not found.'.format(key))
+        return node
+
+    # Detach the removed and moved nodes, one pass per affected container.
+    detached = {}
+    for key in patch['removed']:
+        _get_node(key)
+        detached.setdefault(index[key][1], set()).add(key)
+    moved = [(move['key'], move['parent']) for move in patch['moved'] if move['key'] not in index
+             or index[move['key']][1] != move['parent']]
+    for key, _ in moved:
+        _get_node(key)
+        detached.setdefault(index[key][1], set()).add(key)
+    for parent_key, child_keys in detached.items():
+        parent = nodes[parent_key]
+        parent['children'] = [child for child in parent['children'] if keys[id(child)] not in child_keys]
+
+    # Attach the added and moved nodes, their positions are fixed by 'order' below.
+    for addition in patch['added']:
+        node = _copy_node(addition['node'])
+        _get_node(addition['parent']).setdefault('children', []).append(node)
+        nodes[addition['key']] = node
+        keys[id(node)] = addition['key']
+    for key, parent_key in moved:
+        _get_node(parent_key).setdefault('children', []).append(nodes[key])
+
+    for change in patch['changed']:
+        node = _get_node(change['key'])
+        node.update(change.get('set', {}))
+        for name in change.get('unset', ()):
+            node.pop(name, None)
+    for parent_key, child_keys in patch['order'].items():
+        parent = _get_node(parent_key)
+        children = {keys[id(child)]: child for child in parent.get('children', ())}
+        if len(children) != len(child_keys) or not children.keys() >= set(child_keys):
+            raise ValueError('the patch does not match the bookmarks, children of {!r} differ.'.format(parent_key))
+        parent['children'] = [children[child_key] for child_key in child_keys]
+        for position, child in enumerate(parent['children']):
+            child['index'] = position
+    return bookmarks_json
+
+def count_patch(patch):
+    """Return the numbers of removed, added, moved and changed nodes in the patch."""
+    return {name: len(patch[name]) for name in ('removed', 'added', 'moved', 'changed')}
+
+def load_patch(patch_name):
+    """Load the patch from the file."""
+    with open(patch_name, 'r', encoding='UTF-8') as patch_file:
+        return json_backend.loads(patch_file.read())
+
+def save_json(obj, output_name):
+    """Serialize the patch or bookmarks tree to the output file."""
+    with open(output_name, 'w', encoding='UTF-8') as output_file:
+        json_backend.dump(obj, output_file)
+
+def _parse_arguments(args=None):
+    """Setup and parse program arguments."""
+    import argparse # Only the command line needs it.
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    diff_parser = subparsers.add_parser('diff', help='Compare two bookmarks backups and write the patch.')
+    diff_parser.add_argument('old', help='The name of the original bookmarks file. (input file)')
+    diff_parser.add_argument('new', help='The name of the modified bookmarks file. (input file)')
+    diff_parser.add_argument('-o', '--output', default='bookmarks-patch.json', help='The name of the patch file. (output file)')
+    apply_parser = subparsers.add_parser('apply', help='Apply the patch to a bookmarks backup.')
+    apply_parser.add_argument('bookmarks', help='The name of the bookmarks file the patch is made from. (input file)')
+    apply_parser.add_argument('patch', help='The name of the patch file. (input file)')
+    apply_parser.add_argument('-o', '--output', default='bookmarks-output.json', help='The name of the patched bookmarks file. (output file)')
+    for subparser in (diff_parser, apply_parser):
+        subparser.add_argument('--compact', action='store_true', help='Share repeated values while loading the bookmarks to reduce memory usage.')
+    return parser.parse_args(args)
+
+def main():
+    """Main function."""
+    arguments = _parse_arguments()
+    if arguments.command == 'diff':
+        inputs = (arguments.old, arguments.new)
+    else:
+        inputs = (arguments.bookmarks, arguments.patch)
+    for input_name in inputs:
+        if not os.path.isfile(input_name):
+            print('Error: the input file "{}" does not exist.'.format(input_name))
+            return
+    if arguments.command == 'diff':
+        patch = diff_bookmarks(nicofox2bookmarks.bj_load(arguments.old, arguments.compact),
+                               nicofox2bookmarks.bj_load(arguments.new, arguments.compact))
+        save_json(patch, arguments.output)
+    else:
+        patch = load_patch(arguments.patch)
+        bookmarks_json = nicofox2bookmarks.bj_load(arguments.bookmarks, arguments.compact)
+        try:
+            apply_patch(bookmarks_json, patch)
+        except ValueError as ex:
+            print('Error: {}'.format(ex))
+            return
+        save_json(bookmarks_json, arguments.output)
+    print('{removed} removed, {added} added, {moved} moved, {changed} changed.'.format(**count_patch(patch)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+"""json_backend.py
+
+JSON parsing and serialization for bookmarks.
+Despite the stdlib "json" module can deal the work.
+It will be faster if the 3rd-party "orjson" or "ujson" package is installed.
+
+The results are the same as the stdlib for bookmarks data, with two differences:
+- orjson reads integers beyond the 64-bit range as floats, without error.
+- ujson writes floats in exponent notation with a one-digit exponent, like 1e-7 for 1e-07.
+Firefox backups only hold strings, 64-bit integers and floats without exponent.
+"""
+import functools
+import json
+
+# The 3rd-party packages take longer to import than the stdlib, they are looked up on first use.
+@functools.lru_cache(maxsize=None)
+def _find_loads_backend():
+    try:
+        import orjson
+        return 'orjson', orjson.loads
+    except ImportError: # 3rd-party "orjson" package is not installed.
+        pass
+    try:
+        import ujson
+        return 'ujson', ujson.loads
+    except ImportError: # 3rd-party "ujson" package is not installed either.
+        return 'json', json.loads
+
+# orjson can only write compact UTF-8 output, so it is never used to serialize.
+@functools.lru_cache(maxsize=None)
+def _find_dumps_backend():
+    try:
+        import ujson
+    except ImportError: # 3rd-party "ujson" package is not installed.
+        return 'json', json.dumps
+
+    def _ujson_dumps(obj):
+        # Mimic the default output format of the stdlib, which also escapes DEL (U+007F) as \u007f.
+        text = ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False, separators=(', ', ': '))
+        return text.replace('\x7f', '\\u007f')
+    return 'ujson', _ujson_dumps
+
+def get_loads_backend():
+    """Return the name of the backend used by loads(): "orjson", "ujson" or "json"."""
+    return _find_loads_backend()[0]
+
+def get_dumps_backend():
+    """Return the name of the backend used by dumps() and dump(): "ujson" or "json"."""
+    return _find_dumps_backend()[0]
+
+def loads(data, object_hook=None):
+    """Parse JSON text (str or UTF-8 bytes) and return the object.
+
+    Fast backends do not support object hooks, the stdlib is used when object_hook is given.
+    """
+    if object_hook is not None:
+        return json.loads(data, object_hook=object_hook)
+    try:
+        return _find_loads_backend()[1](data)
+    except (ValueError, OverflowError):
+        # Let the stdlib decide about the inputs which fast backends refuse. (NaN, huge integers,
+        # lone surrogates, ...)
+        return json.loads(data)
+
+def dumps(obj):
+    """Serialize the object to JSON text."""
+    try:
+        return _find_dumps_backend()[1](obj)
+    except (ValueError, OverflowError, TypeError):
+        return json.dumps(obj)
+
+def dump(obj, file):
+    """Serialize the object to JSON text and write it to the (text) file.
+
+    The stdlib writes the text piece by piece, ujson builds the whole text in memory first.
+    """
+    if get_dumps_backend() == 'json':
+        json.dump(obj, file)
+    else:
+        file.write(dumps(obj))
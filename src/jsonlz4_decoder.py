@@ -4,80 +4,335 @@
 Implementation that against the decoding of Firefox's compressed bookmarks.
 Despite this pure Python implementation can deal the work.
 It will be much faster if the 3rd-party "lz4" package is installed.
+The backend can be chosen by select_backend(), the NICOFOX2BOOKMARKS_JSONLZ4_BACKEND
+environment variable or the --backend flag, or decided by benchmark with --auto-benchmark.
+JsonLz4Decoder and iter_decompress_jsonlz4 decode incrementally with bounded memory.
 """
-import argparse
 import os
-import traceback
+import sys
 
 _JSONLZ4_MAGIC = b'mozLz40\0'
 _JSONLZ4_MAGIC_LEN = len(_JSONLZ4_MAGIC)
+_JSONLZ4_HEADER_LEN = _JSONLZ4_MAGIC_LEN + 4 # magic + uint32 decompressed size
+_CHUNK_SIZE = 0x10000
+_BENCHMARK_CACHE_FILENAME = 'jsonlz4_backend.json'
+
+BACKEND_ENV_VAR = 'NICOFOX2BOOKMARKS_JSONLZ4_BACKEND'
 
 def _raise_bad_signature():
     raise ValueError('invalid signature for jsonlz4 file.')
 
-try:
-    import lz4
+_LZ4_WINDOW_SIZE = 0x10000 # LZ4 matches never refer further back than 64 KiB.
+_LZ4_MIN_MATCH = 4
+
+class JsonLz4Decoder:
+    """Incremental decoder of JsonLz4 bookmarks format.
+
+    Feed the compressed data piece by piece and get the decompressed data as soon as it is decoded.
+    Only the last 64 KiB of output (the LZ4 back-reference window) is kept between feeds.
+
+    Usage:
+        decoder = JsonLz4Decoder()
+        for piece in pieces:
+            output_file.write(decoder.feed(piece))
+        decoder.close()
+    """
+
+    def __init__(self):
+        self._pending = bytearray() # Input which can not be decoded yet.
+        self._window = bytearray() # Recent output for back-references.
+        self._decompressed_size = None
+        self._produced = 0
+
+    @property
+    def decompressed_size(self):
+        """The decompressed size recorded in the header, or None if the header is not fed yet."""
+        return self._decompressed_size
+
+    @property
+    def eof(self):
+        """Is the whole block decoded."""
+        return self._decompressed_size is not None and self._produced >= self._decompressed_size
+
+    def feed(self, data):
+        """Feed compressed data and return the newly decompressed bytes. (may be empty)"""
+        pending = self._pending
+        pending += data
+        if self._decompressed_size is None:
+            if len(pending) < _JSONLZ4_HEADER_LEN:
+                return b''
+            if pending[:_JSONLZ4_MAGIC_LEN] != _JSONLZ4_MAGIC:
+                _raise_bad_signature()
+            self._decompressed_size = int.from_bytes(pending[_JSONLZ4_MAGIC_LEN:_JSONLZ4_HEADER_LEN], 'little')
+            del pending[:_JSONLZ4_HEADER_LEN]
+        window = self._window
+        start = len(window)
+        consumed = self._decode_sequences(pending, window)
+        del pending[:consumed]
+        output = bytes(window[start:])
+        self._produced += len(output)
+        if len(window) > _LZ4_WINDOW_SIZE:
+            del window[:-_LZ4_WINDOW_SIZE]
+        return output
+
+    def close(self):
+        """Finish decoding, raise ValueError if the fed data is truncated."""
+        if not self.eof:
+            raise ValueError('truncated jsonlz4 data.')
+
+    def _decode_sequences(self, src, window):
+        """Decode as many complete LZ4 sequences from src as possible and return the consumed length."""
+        src_size = len(src)
+        remaining = self._decompressed_size - self._produced
+        base = len(window)
+        pos = 0
+        while len(window) - base < remaining and pos < src_size:
+            cursor = pos
+            token = src[cursor]
+            cursor += 1
+            # Un-compressed literals.
+            literals_length = token >> 4 # hi-byte of token
+            if literals_length == 0x0f:
+                while True:
+                    if cursor >= src_size:
+                        return pos
+                    byte = src[cursor]
+                    cursor += 1
+                    literals_length += byte
+                    if byte != 0xff:
+                        break
+            if cursor + literals_length > src_size:
+                return pos
+            literals_end = cursor + literals_length
+            if len(window) - base + literals_length >= remaining: # The last sequence has no match part.
+                window += src[cursor:literals_end]
+                return literals_end
+            # Duplication part.
+            if literals_end + 2 > src_size:
+                return pos
+            match_offset = src[literals_end] | (src[literals_end + 1] << 8)
+            match_cursor = literals_end + 2
+            match_length = token & 0x0f # lo-byte of token
+            if match_length == 0x0f:
+                while True:
+                    if match_cursor >= src_size:
+                        return pos
+                    byte = src[match_cursor]
+                    match_cursor += 1
+                    match_length += byte
+                    if byte != 0xff:
+                        break
+            match_length += _LZ4_MIN_MATCH
+            if match_offset == 0 or match_offset > len(window) + literals_length:
+                raise ValueError('invalid match offset in jsonlz4 data.')
+            window += src[cursor:literals_end]
+            if match_length >= match_offset: # RLE expansion.
+                window += window[-match_offset:] * (match_length // match_offset)
+                match_length %= match_offset
+            window += window[-match_offset : -match_offset + match_length]
+            pos = match_cursor
+        return pos
+
+def read_decompressed_size(file):
+    """Read only the header of a jsonlz4 file (opened in binary mode) and return the decompressed size."""
+    header = file.read(_JSONLZ4_HEADER_LEN)
+    if len(header) < _JSONLZ4_HEADER_LEN or header[:_JSONLZ4_MAGIC_LEN] != _JSONLZ4_MAGIC:
+        _raise_bad_signature()
+    return int.from_bytes(header[_JSONLZ4_MAGIC_LEN:], 'little')
 
-    def decompress_jsonlz4(data):
-        """Decompress JsonLz4 bookmarks format."""
+def iter_decompress_jsonlz4(chunks):
+    """Decompress JsonLz4 bookmarks format from an iterable of data chunks, yield decompressed chunks."""
+    decoder = JsonLz4Decoder()
+    for chunk in chunks:
+        output = decoder.feed(chunk)
+        if output:
+            yield output
+        if decoder.eof:
+            break
+    decoder.close()
+
+def _decompress_jsonlz4_python(data):
+    decoder = JsonLz4Decoder()
+    decompressed = decoder.feed(data)
+    decoder.close()
+    return decompressed
+
+def _load_python_backend():
+    return _decompress_jsonlz4_python
+
+def _load_lz4_backend():
+    import lz4.block # Raise ImportError if the 3rd-party "lz4" package is not installed.
+
+    def _decompress_jsonlz4_lz4(data):
         if data[:_JSONLZ4_MAGIC_LEN] != _JSONLZ4_MAGIC:
             _raise_bad_signature()
         return lz4.block.decompress(data[_JSONLZ4_MAGIC_LEN:])
+    return _decompress_jsonlz4_lz4
 
-except ImportError: # 3rd-party "lz4" package is not installed.
-    import struct
-    import io
-
-    def _consume_byte(stream):
-        return struct.unpack('B', stream.read(1))[0]
-
-    def _consume_uint16_le(stream):
-        return struct.unpack('<H', stream.read(2))[0]
-
-    def _consume_uint32_le(stream):
-        return struct.unpack('<I', stream.read(4))[0]
-
-    def _decode_lsic(stream):
-        """Decode linear small-integer code."""
-        number = 0
-        last_byte = _consume_byte(stream)
-        while last_byte == 0xff:
-            number += 0xff
-            last_byte = _consume_byte(stream)
-        number += last_byte
-        return number
-
-    def _decompress_lz4_block(stream, decompressed, data_size):
-        token = _consume_byte(stream)
-        # Copy un-compressed literals to output buffer.
-        literals_length = token >> 4 # hi-byte of token
-        if literals_length == 0x0f:
-            literals_length += _decode_lsic(stream)
-        decompressed += stream.read(literals_length)
-        if stream.tell() == data_size:
-            return # Reach the end.
-        # Reproduce duplication part.
-        match_offset = _consume_uint16_le(stream)
-        match_length = token & 0x0f # lo-byte of token
-        if match_length == 0x0f:
-            match_length += _decode_lsic(stream)
-        match_length += 4 # minimum match length
-        if match_length >= match_offset: # RLE expansion.
-            decompressed += decompressed[-match_offset:] * (match_length // match_offset)
-            match_length %= match_offset
-        decompressed += decompressed[-match_offset : -match_offset + match_length]
-
-    def decompress_jsonlz4(data):
-        """Decompress JsonLz4 bookmarks format."""
-        data_size = len(data)
-        stream = io.BytesIO(data)
-        if stream.read(_JSONLZ4_MAGIC_LEN) != _JSONLZ4_MAGIC:
-            _raise_bad_signature()
-        decompressed_size = _consume_uint32_le(stream)
-        decompressed = bytearray()
-        while len(decompressed) < decompressed_size:
-            _decompress_lz4_block(stream, decompressed, data_size)
-        return decompressed
+# Backend name -> loader. A loader returns the decompress function or raises ImportError.
+# Backends registered earlier are preferred when no backend is selected explicitly.
+_backend_loaders = {}
+_loaded_backends = {}
+_selected_backend = None
+
+def register_backend(name, loader, preferred=False):
+    """Register a decompression backend.
+
+    The loader is called once on first use, it returns a function which takes the whole jsonlz4 data
+    and returns the decompressed bytes, or raises ImportError if the backend is not available.
+    """
+    global _backend_loaders
+    if preferred:
+        _backend_loaders = dict([(name, loader)] + [item for item in _backend_loaders.items() if item[0] != name])
+    else:
+        _backend_loaders[name] = loader
+    _loaded_backends.pop(name, None)
+
+register_backend('lz4', _load_lz4_backend)
+register_backend('python', _load_python_backend)
+
+def _load_backend(name):
+    try:
+        return _loaded_backends[name]
+    except KeyError:
+        pass
+    try:
+        loader = _backend_loaders[name]
+    except KeyError:
+        raise ValueError('unknown jsonlz4 backend: {!r}.'.format(name)) from None
+    try:
+        function = loader()
+    except ImportError:
+        function = None
+    _loaded_backends[name] = function
+    return function
+
+def get_registered_backends():
+    """Return the names of all registered backends."""
+    return list(_backend_loaders)
+
+def get_available_backends():
+    """Return the names of the backends which can be loaded in this environment."""
+    return [name for name in _backend_loaders if _load_backend(name) is not None]
+
+def check_backend(name):
+    """Return the name if the backend is registered and available, otherwise raise ValueError."""
+    if name not in _backend_loaders:
+        raise ValueError('unknown jsonlz4 backend: {!r} (choose from {}).'.format(
+            name, ', '.join(get_registered_backends())))
+    if _load_backend(name) is None:
+        raise ValueError('jsonlz4 backend {!r} is not available.'.format(name))
+    return name
+
+def select_backend(name):
+    """Select the backend used by decompress_jsonlz4(), raise ValueError if it is not available."""
+    global _selected_backend
+    _selected_backend = check_backend(name)
+
+def get_backend():
+    """Return the name of the backend used by decompress_jsonlz4().
+
+    If no backend is selected, it is decided by the environment variable, then the cached benchmark
+    result, then the first available backend in registration order.
+    """
+    global _selected_backend
+    if _selected_backend is None:
+        name = os.getenv(BACKEND_ENV_VAR)
+        if name:
+            select_backend(name) # An explicit but unusable choice is an error.
+        else:
+            name = _read_cached_backend()
+            if name in _backend_loaders and _load_backend(name) is not None:
+                _selected_backend = name
+            else:
+                _selected_backend = get_available_backends()[0]
+    return _selected_backend
+
+def decompress_jsonlz4(data):
+    """Decompress JsonLz4 bookmarks format."""
+    return _load_backend(get_backend())(data)
+
+def _get_benchmark_cache_path():
+    cache_dir = os.getenv('LOCALAPPDATA') or os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'nicofox2bookmarks', _BENCHMARK_CACHE_FILENAME)
+
+def _get_machine_key():
+    # Same as platform.node() and platform.machine() without importing platform.
+    if hasattr(os, 'uname'):
+        node, machine = os.uname().nodename, os.uname().machine
+    else:
+        node, machine = os.getenv('COMPUTERNAME', ''), os.getenv('PROCESSOR_ARCHITECTURE', '')
+    return '{}|{}|{}.{}.{}'.format(node, machine, *sys.version_info[:3])
+
+def _read_cached_backend():
+    import json
+    try:
+        with open(_get_benchmark_cache_path(), 'r', encoding='UTF-8') as cache_file:
+            return json.load(cache_file).get(_get_machine_key())
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _write_cached_backend(name):
+    import json
+    path = _get_benchmark_cache_path()
+    try:
+        with open(path, 'r', encoding='UTF-8') as cache_file:
+            cache = json.load(cache_file)
+        if not isinstance(cache, dict):
+            cache = {}
+    except (OSError, ValueError):
+        cache = {}
+    cache[_get_machine_key()] = name
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='UTF-8') as cache_file:
+        json.dump(cache, cache_file)
+
+def _make_benchmark_sample(sequences=20000):
+    """Build a valid jsonlz4 sample made of short literals and back-references, like a bookmarks backup."""
+    block = bytearray()
+    decompressed_size = 0
+    for number in range(sequences):
+        literals = '{{"index":{},'.format(number).encode('ascii')[-14:]
+        # token: literals length (< 15), match length 12 + 4 minimum.
+        block.append((len(literals) << 4) | 12)
+        block += literals
+        block += min(decompressed_size + len(literals), 40).to_bytes(2, 'little')
+        decompressed_size += len(literals) + 16
+    # LZ4 requires the block to end with at least 12 bytes of literals.
+    literals = b'{"index":-1}]'
+    block.append(len(literals) << 4)
+    block += literals
+    decompressed_size += len(literals)
+    return _JSONLZ4_MAGIC + decompressed_size.to_bytes(4, 'little') + bytes(block)
+
+def benchmark_backends(sample=None, repeat=3):
+    """Time each available backend on the sample, return a list of (seconds, name) sorted by speed."""
+    import time
+    if sample is None:
+        sample = _make_benchmark_sample()
+    results = []
+    for name in get_available_backends():
+        function = _load_backend(name)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(sample)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((best, name))
+    results.sort()
+    return results
+
+def auto_select_backend(sample=None):
+    """Benchmark the available backends, select the fastest one and cache the choice for this machine."""
+    results = benchmark_backends(sample)
+    fastest = results[0][1]
+    select_backend(fastest)
+    try:
+        _write_cached_backend(fastest)
+    except OSError:
+        pass # Caching is only an optimization.
+    return results
 
 def _make_new_filename(filename):
     try:
@@ -90,23 +345,50 @@ def _make_new_filename(filename):
 
 def _parse_arguments(args=None):
     """Setup and parse program arguments."""
+    import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('filenames', nargs='+', help='jsonlz4 files to decompress.')
-    return parser.parse_args(args)
+    parser.add_argument('filenames', nargs='*', help='jsonlz4 files to decompress.')
+    backend_group = parser.add_mutually_exclusive_group()
+    backend_group.add_argument('--backend', help='The decompression backend: {}.'.format(', '.join(get_registered_backends())))
+    backend_group.add_argument('--auto-benchmark', action='store_true', help='Benchmark the available backends, use and remember the fastest one.')
+    arguments = parser.parse_args(args)
+    if arguments.backend:
+        try:
+            check_backend(arguments.backend)
+        except ValueError as ex:
+            parser.error('argument --backend: {}'.format(ex))
+    return arguments
 
 def main():
     """Main function."""
     arguments = _parse_arguments()
+    backend_from_env = os.getenv(BACKEND_ENV_VAR)
+    if arguments.backend:
+        select_backend(arguments.backend)
+    elif arguments.auto_benchmark:
+        for seconds, name in auto_select_backend():
+            print('Backend {}: {:.2f} ms'.format(name, seconds * 1000))
+    elif backend_from_env:
+        # Check it before decompressing anything, like --backend.
+        try:
+            check_backend(backend_from_env)
+        except ValueError as ex:
+            print('Error: environment variable {}: {}'.format(BACKEND_ENV_VAR, ex))
+            return
+    print('Backend:', get_backend())
     for filename in arguments.filenames:
         print('Decompress:', filename)
         try:
-            with open(filename, 'rb') as file:
-                data = file.read()
-            data = decompress_jsonlz4(data)
-            with open(_make_new_filename(filename), 'wb') as file:
-                file.write(data)
+            with open(filename, 'rb') as input_file, open(_make_new_filename(filename), 'wb') as output_file:
+                if get_backend() == 'python':
+                    chunks = iter(lambda: input_file.read(_CHUNK_SIZE), b'')
+                    for data in iter_decompress_jsonlz4(chunks):
+                        output_file.write(data)
+                else:
+                    output_file.write(decompress_jsonlz4(input_file.read()))
             print('  OK!')
         except Exception:
+            import traceback
             print('  Failed!')
             traceback.print_exc()
 
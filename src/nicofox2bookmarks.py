@@ -1,15 +1,44 @@
 # -*- coding: UTF-8 -*-
-import argparse
-import json
-import pathlib
+import datetime
+import functools
+import itertools
+import os
+import re
 import sqlite3
+import sys
 import time
 
-import firefox_helper
+import json_backend
+
+# argparse and the helpers for default filenames, jsonlz4 input and spilling (firefox_helper,
+# jsonlz4_decoder and spilling) are imported where they are used, so short runs only pay for what they need.
 
 __title__ = 'NicoFox to Firefox Bookmarks'
 __version__ = '0.1.0'
 
+PARALLEL_CHUNK_SIZE = 5000 # Number of bookmarks encoded by a worker process at once.
+
+# Cost model of estimate_port(), measured on CPython 3.11.
+_ESTIMATE_IMPORT_ROW_NS = 2800 # Import a row.
+_ESTIMATE_BUILD_ROW_NS = 2800 # Build the bookmark item of a row.
+_ESTIMATE_DATE_SHARD_ROW_NS = 5000 # Bucket a row by year or month.
+_ESTIMATE_SPILLED_DATE_SHARD_ROW_NS = 6500 # Bucket a spilled row by year or month in the scratch database.
+_ESTIMATE_PARALLEL_ROW_NS = 2200 # Send a row to a worker process and get its JSON back.
+_ESTIMATE_PARALLEL_START_NS = 100000000 # Start the worker processes.
+_ESTIMATE_SPILL_ROW_NS = 1000 # Spill a row to the scratch database and read it back.
+_ESTIMATE_LOAD_NS_PER_BYTE = 22 # Parse the bookmarks backup.
+_ESTIMATE_SPILL_LOAD_NS_PER_BYTE = 57 # Copy and scan the bookmarks backup which is spilled.
+_ESTIMATE_DECOMPRESS_NS_PER_BYTE = 50 # Decompress jsonlz4 in pure Python.
+_ESTIMATE_SAVE_NS_PER_BYTE = 12 # Serialize the output.
+_ESTIMATE_STREAM_SAVE_NS_PER_BYTE = 22 # Serialize the output piece by piece under a memory budget.
+_ESTIMATE_BOOKMARK_JSON_SIZE = 135 # A bookmark item without its strings.
+_ESTIMATE_DESCRIPTION_JSON_SIZE = 100 # The annos of description without its value.
+_ESTIMATE_SUBFOLDER_JSON_SIZE = 155 # A subfolder of sharding with a short title.
+
+_SHARD_DATE_FORMATS = {'year': '%Y', 'month': '%Y-%m'} # Shard mode -> title format of subfolders.
+# Keys of bookmark nodes whose (string) values are shared by bj_make_compact_hook().
+_COMPACT_SHARED_KEYS = frozenset(('type', 'root', 'name', 'charset', 'tags', 'iconuri', 'keyword'))
+
 def _create_bookmark_data():
     return {
         'title': '',
@@ -25,31 +54,265 @@ def create_metadata():
         'container': 'NicoFox',
         'description': '',
         'common_tags': None,
+        'shard': None, # None, 'year', 'month' or the maximum size (int) of each subfolder.
         }
 
+def create_filters():
+    """Create a default (no filtering) filters dictionary for importing NicoFox database."""
+    return {
+        'since': None, # datetime, inclusive.
+        'until': None, # datetime, exclusive.
+        'url_prefix': None,
+        'url_glob': None, # SQLite GLOB pattern, case sensitive.
+        'title_contains': None, # Case insensitive for ASCII letters.
+        'limit': None,
+        }
+
+def datetime_to_nicofox_time(date_time):
+    return int(date_time.timestamp() * 1000)
+
 def nicofox_time_to_bookmark_time(nicofox_time):
     return nicofox_time * 1000
 
 def posix_time_to_bookmark_time(posix_time):
     return posix_time * 1000000
 
-def import_nicofox_db(db_name):
-    """Import data from NicoFox database and return it as bookmarks."""
+def bookmark_time_to_datetime(bookmark_time):
+    return datetime.datetime.fromtimestamp(bookmark_time / 1000000)
+
+def shard_bookmarks(bookmarks, shard):
+    """Split the bookmarks into buckets in one pass and return them as a list of (title, bookmarks).
+
+    If shard is 'year' or 'month', bookmarks are bucketed by their add_time and the buckets are sorted
+    by date; if it is an integer, bookmarks are split into fixed-size buckets in their original order.
+    Spilled bookmarks are bucketed by the scratch database instead.
+    """
+    spilling = sys.modules.get('spilling') # Spilled bookmarks can only exist once it is imported.
+    if spilling is not None and isinstance(bookmarks, spilling.SpilledBookmarks):
+        if isinstance(shard, int):
+            return bookmarks.shard_by_size(shard)
+        return bookmarks.shard_by_date(_SHARD_DATE_FORMATS[shard])
+    if isinstance(shard, int):
+        if shard <= 0:
+            raise ValueError('The shard size must be positive.')
+        buckets = []
+        iterator = iter(bookmarks)
+        for start in itertools.count(1, shard):
+            chunk = list(itertools.islice(iterator, shard))
+            if not chunk:
+                break
+            buckets.append(('{}-{}'.format(start, start + len(chunk) - 1), chunk))
+        return buckets
+    try:
+        title_format = _SHARD_DATE_FORMATS[shard]
+    except KeyError:
+        raise ValueError('Unknown shard mode: {!r}.'.format(shard)) from None
+    buckets = {}
+    for bookmark in bookmarks:
+        title = bookmark_time_to_datetime(bookmark['add_time']).strftime(title_format)
+        try:
+            buckets[title].append(bookmark)
+        except KeyError:
+            buckets[title] = [bookmark]
+    return sorted(buckets.items())
+
+def parse_shard(text):
+    """Parse the shard option from text, return 'year', 'month', a positive integer or None."""
+    text = text.strip().lower() if text else ''
+    if not text:
+        return None
+    if text in _SHARD_DATE_FORMATS:
+        return text
+    try:
+        size = int(text)
+    except ValueError:
+        raise ValueError('Shard must be "year", "month" or a positive integer.') from None
+    if size <= 0:
+        raise ValueError('Shard must be "year", "month" or a positive integer.')
+    return size
+
+def parse_filter_time(text):
+    """Parse local date (and time) in ISO format like "2017-09-03" or "2017-09-03 21:12" for filters."""
+    return datetime.datetime.fromisoformat(text.strip())
+
+def parse_memory_size(text):
+    """Parse the memory budget like "512M" or "2GiB" and return it in bytes."""
+    import spilling
+    return spilling.parse_memory_size(text)
+
+def parse_url_filter(filters, text):
+    """Set the URL filter from text, as a glob pattern if it contains wildcards, otherwise as a prefix."""
+    text = text.strip()
+    filters['url_prefix'] = filters['url_glob'] = None
+    if any(char in text for char in '*?['):
+        filters['url_glob'] = text
+    elif text:
+        filters['url_prefix'] = text
+
+def compile_filters(filters):
+    """Compile filters into a parameterized SQL clause (WHERE and LIMIT) for smilefox table.
+
+    Return the clause and its parameters. Range conditions are used where possible, so that SQLite
+    can use the index on add_time or url if there is one.
+    """
+    conditions = []
+    parameters = []
+    if filters is None:
+        return '', parameters
+    if filters.get('since') is not None:
+        conditions.append('add_time >= ?')
+        parameters.append(datetime_to_nicofox_time(filters['since']))
+    if filters.get('until') is not None:
+        conditions.append('add_time < ?')
+        parameters.append(datetime_to_nicofox_time(filters['until']))
+    url_prefix = filters.get('url_prefix')
+    if url_prefix:
+        last_code = ord(url_prefix[-1])
+        # The upper bound must be encodable, so it can not be beyond sys.maxunicode or a surrogate.
+        if last_code < sys.maxunicode and not 0xD800 <= last_code + 1 <= 0xDFFF:
+            # Text is compared as UTF-8 bytes, which is in the order of code points.
+            conditions.append('url >= ? AND url < ?')
+            parameters.extend((url_prefix, url_prefix[:-1] + chr(last_code + 1)))
+        else:
+            conditions.append('substr(url, 1, ?) = ?')
+            parameters.extend((len(url_prefix), url_prefix))
+    if filters.get('url_glob'):
+        conditions.append('url GLOB ?')
+        parameters.append(filters['url_glob'])
+    if filters.get('title_contains'):
+        escaped = filters['title_contains']
+        for char in '\\%_':
+            escaped = escaped.replace(char, '\\' + char)
+        conditions.append("video_title LIKE ? ESCAPE '\\'")
+        parameters.append('%' + escaped + '%')
+    clause = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    if filters.get('limit') is not None:
+        clause += ' LIMIT ?'
+        parameters.append(filters['limit'])
+    return clause, parameters
+
+def iter_nicofox_db(db_name, filters=None):
+    """Import data from NicoFox database and yield it as bookmarks one by one."""
+    clause, parameters = compile_filters(filters)
     with sqlite3.connect(db_name) as smilefox:
-        all_bookmarks = []
-        for row in smilefox.execute('SELECT video_title, url, description, add_time FROM smilefox;'):
+        query = 'SELECT video_title, url, description, add_time FROM smilefox{};'.format(clause)
+        for row in smilefox.execute(query, parameters):
             bookmark = _create_bookmark_data()
             bookmark['title'] = row[0]
             bookmark['url'] = row[1]
             bookmark['description'] = row[2]
             bookmark['add_time'] = nicofox_time_to_bookmark_time(row[3])
-            all_bookmarks.append(bookmark)
-        return all_bookmarks
+            yield bookmark
+
+def import_nicofox_db(db_name, filters=None):
+    """Import data from NicoFox database and return it as bookmarks."""
+    return list(iter_nicofox_db(db_name, filters))
+
+def count_nicofox_db(db_name, filters=None):
+    """Return the number of items in NicoFox database."""
+    clause, parameters = compile_filters(filters)
+    with sqlite3.connect(db_name) as smilefox:
+        query = 'SELECT COUNT(*) FROM (SELECT 1 FROM smilefox{});'.format(clause)
+        return smilefox.execute(query, parameters).fetchone()[0]
+
+def inspect_nicofox_db(db_name, filters=None):
+    """Return the aggregates of NicoFox database (counts, text lengths, time range) without reading rows."""
+    clause, parameters = compile_filters(filters)
+    with sqlite3.connect(db_name) as smilefox:
+        row = smilefox.execute(
+            "SELECT COUNT(*), COUNT(NULLIF(description, '')),"
+            " TOTAL(IFNULL(LENGTH(video_title), 0) + IFNULL(LENGTH(url), 0) + IFNULL(LENGTH(description), 0)),"
+            " TOTAL(IFNULL(LENGTH(CAST(video_title AS BLOB)), 0) + IFNULL(LENGTH(CAST(url AS BLOB)), 0)"
+            " + IFNULL(LENGTH(CAST(description AS BLOB)), 0)),"
+            " MIN(add_time), MAX(add_time)"
+            " FROM (SELECT video_title, url, description, add_time FROM smilefox{});".format(clause),
+            parameters).fetchone()
+    return {
+        'rows': row[0],
+        'described_rows': row[1],
+        'text_length': int(row[2]),
+        'text_bytes': int(row[3]),
+        'first_add_time': nicofox_time_to_bookmark_time(row[4]) if row[4] is not None else None,
+        'last_add_time': nicofox_time_to_bookmark_time(row[5]) if row[5] is not None else None,
+        }
+
+def count_nicofox_date_buckets(db_name, title_format, filters=None):
+    """Return the number of distinct dates (local time formatted by title_format) of items in NicoFox database."""
+    clause, parameters = compile_filters(filters)
+    with sqlite3.connect(db_name) as smilefox:
+        query = ("SELECT COUNT(DISTINCT strftime(?, add_time / 1000, 'unixepoch', 'localtime'))"
+                 " FROM (SELECT add_time FROM smilefox{});".format(clause))
+        return smilefox.execute(query, [title_format] + parameters).fetchone()[0]
+
+def estimate_port(db_name, json_name, meta_data, filters=None, jobs=1, max_memory=None):
+    """Estimate the output size (bytes) and duration (milliseconds) of a port without doing it.
+
+    Only aggregates of NicoFox database and the size of bookmarks backup (the header of jsonlz4) are read.
+    The sharding of meta_data, jobs and max_memory are taken into account as Porter uses them.
+    """
+    import jsonlz4_decoder
+    import spilling
+    nicofox = inspect_nicofox_db(db_name, filters)
+    rows = nicofox['rows']
+    backup_size = spilling.get_json_text_size(json_name)
+    # Non-ASCII characters (mostly 3 bytes in UTF-8) are escaped as 6 bytes.
+    non_ascii = (nicofox['text_bytes'] - nicofox['text_length']) // 2
+    text_size = nicofox['text_length'] + 5 * non_ascii
+    tags_size = len(','.join(meta_data['common_tags'])) + 10 if meta_data['common_tags'] else 0
+    shard = meta_data.get('shard')
+    if not shard or not rows:
+        subfolders = 0
+    elif isinstance(shard, int):
+        subfolders = -(-rows // shard)
+    else:
+        subfolders = count_nicofox_date_buckets(db_name, _SHARD_DATE_FORMATS[shard], filters)
+    new_size = (text_size
+        + rows * (_ESTIMATE_BOOKMARK_JSON_SIZE + tags_size)
+        + nicofox['described_rows'] * _ESTIMATE_DESCRIPTION_JSON_SIZE
+        + subfolders * _ESTIMATE_SUBFOLDER_JSON_SIZE)
+    output_size = backup_size + len(meta_data['container']) + len(meta_data['description']) + new_size
+
+    # Decide what would be spilled, like Porter and SpillStore.collect_bookmarks() do.
+    spill_backup = spill_bookmarks = False
+    if max_memory is not None:
+        tree_memory = backup_size * spilling.TREE_MEMORY_FACTOR
+        spill_backup = tree_memory > max_memory
+        memory_left = max_memory if spill_backup else max_memory - tree_memory
+        bookmarks_memory = rows * spilling.BOOKMARK_MEMORY_OVERHEAD + 2 * nicofox['text_length']
+        spill_bookmarks = bookmarks_memory > memory_left
+
+    save_ns_per_byte = _ESTIMATE_SAVE_NS_PER_BYTE if max_memory is None else _ESTIMATE_STREAM_SAVE_NS_PER_BYTE
+    duration_ns = (rows * _ESTIMATE_IMPORT_ROW_NS
+        + backup_size * (_ESTIMATE_SPILL_LOAD_NS_PER_BYTE if spill_backup else _ESTIMATE_LOAD_NS_PER_BYTE)
+        + (output_size - new_size) * save_ns_per_byte)
+    if json_name.lower().endswith('.jsonlz4') and jsonlz4_decoder.get_backend() == 'python':
+        duration_ns += backup_size * _ESTIMATE_DECOMPRESS_NS_PER_BYTE
+    if shard in _SHARD_DATE_FORMATS:
+        duration_ns += rows * (_ESTIMATE_SPILLED_DATE_SHARD_ROW_NS if spill_bookmarks else _ESTIMATE_DATE_SHARD_ROW_NS)
+    encode_ns = rows * _ESTIMATE_BUILD_ROW_NS + new_size * save_ns_per_byte
+    if spill_bookmarks:
+        encode_ns += rows * _ESTIMATE_SPILL_ROW_NS # Spilled bookmarks are always encoded serially.
+    elif jobs != 1 and rows > PARALLEL_CHUNK_SIZE:
+        cpu_count = os.cpu_count() or 1
+        workers = min(jobs or cpu_count, cpu_count, -(-rows // PARALLEL_CHUNK_SIZE))
+        encode_ns = encode_ns / workers + rows * _ESTIMATE_PARALLEL_ROW_NS + _ESTIMATE_PARALLEL_START_NS
+    duration_ns += encode_ns
+    nicofox.update({
+        'backup_size': backup_size,
+        'output_size': output_size,
+        'subfolders': subfolders,
+        'spill_backup': spill_backup,
+        'spill_bookmarks': spill_bookmarks,
+        'duration_ms': int(duration_ns) // 1000000,
+        })
+    return nicofox
 
 # bj = bookmarks json.
 def bj_seek_in_children_by_guid(node, guid):
     """Search the child item with specific GUID and return it."""
     for item in node['children']:
+        if not isinstance(item, dict):
+            continue # Placeholder of spilled or encoded items.
         try:
             if item['guid'] == guid:
                 return item
@@ -78,7 +341,7 @@ def bj_create_child_container(node, container_data):
     now = posix_time_to_bookmark_time(time.time())
     new_container = {
         'title': container_data.get('title', 'untitled'),
-        'index': len(children),
+        'index': container_data.get('index', len(children)),
         'dateAdded': container_data.get('dateAdded', now),
         'lastModified': container_data.get('lastModified', now),
         'type': 'text/x-moz-place-container',
@@ -97,67 +360,341 @@ def bj_get_menu_container(bookmarks_json):
         raise ValueError('Can not get menu container from nodes other than root.')
     return bj_seek_in_children_by_guid(root, 'menu________')
 
-def bj_load(json_name):
-    """Load the bookmarks JSON and parse it as a JSON object."""
+def bj_make_compact_hook():
+    """Create a JSON object hook which shares repeated values among the nodes of a bookmarks tree.
+
+    The stdlib JSON decoder already reuses key strings, but every node still owns copies of values
+    like 'type', 'root', annotation names and tags. The hook keeps one copy of each of them per load,
+    and lets 'lastModified' share the integer object of 'dateAdded' when they are equal.
+    Nodes stay plain dictionaries so that all bj_* helpers work as usual.
+    """
+    memo = {}
+    def _compact_hook(node):
+        for key in _COMPACT_SHARED_KEYS.intersection(node):
+            value = node[key]
+            if isinstance(value, str):
+                node[key] = memo.setdefault(value, value)
+        date_added = node.get('dateAdded')
+        if date_added is not None and node.get('lastModified') == date_added:
+            node['lastModified'] = date_added
+        return node
+    return _compact_hook
+
+def bj_load(json_name, compact=False):
+    """Load the bookmarks JSON and parse it as a JSON object.
+
+    If compact is True, repeated values are shared among nodes to reduce the memory usage
+    of large backups. (see bj_make_compact_hook)
+    """
     is_jsonlz4 = json_name.lower().endswith('.jsonlz4')
     if is_jsonlz4:
+        import jsonlz4_decoder
         with open(json_name, 'rb') as bookmarks_json_file:
             data = bookmarks_json_file.read()
-        data = firefox_helper.decompress_jsonlz4(data).decode('UTF-8')
+        data = jsonlz4_decoder.decompress_jsonlz4(data).decode('UTF-8')
     else:
         with open(json_name, 'r', encoding='UTF-8') as bookmarks_json_file:
             data = bookmarks_json_file.read()
-    return json.loads(data)
+    if compact:
+        return json_backend.loads(data, object_hook=bj_make_compact_hook())
+    return json_backend.loads(data)
 
-def export_bookmarks_to_json(output_name, json_name, bookmarks, meta_data):
-    """Export the bookmarks imported from NicoFox database to Firefox bookmarks JSON file."""
-    # Load bookmarks.
-    bookmarks_json = bj_load(json_name)
-    # Find the menu container and create a directory in it.
-    menu = bj_get_menu_container(bookmarks_json)
-    archive = bj_create_child_container(menu, {
-        'title': meta_data['container'],
-        'description': meta_data['description']})
-    # Append imported bookmarks to the created directory.
-    archive_children = archive['children']
-    for bookmark in bookmarks:
-        # Build new bookmark item from bookmark data and metadata.
+def bj_build_guid_index(bookmarks_json):
+    """Walk the whole tree once and return a dictionary which maps GUID to node."""
+    index = {}
+    pending = [bookmarks_json]
+    while pending:
+        node = pending.pop()
+        if not isinstance(node, dict):
+            continue # Placeholder of spilled or encoded items.
+        guid = node.get('guid')
+        if guid is not None:
+            index[guid] = node
+        pending.extend(node.get('children', ()))
+    return index
+
+class BookmarkTemplate:
+    """Build new bookmark items from bookmark data, with the per-run work of metadata done once.
+
+    Tags are unique and in a stable order: the bookmark's own tags first, then the common tags.
+    """
+
+    def __init__(self, meta_data):
+        self._common_tags = tuple(dict.fromkeys(meta_data['common_tags'] or ()))
+        # Bookmarks without their own tags share the same string.
+        self._common_tags_text = ','.join(self._common_tags) or None
+        # The constant fields of the description anno, in the order they are serialized.
+        self._description_anno = {
+            'name': 'bookmarkProperties/description',
+            'flags': 0,
+            'expires': 4,
+            }
+
+    def create(self, bookmark, index):
+        """Build new bookmark item at the index."""
+        add_time = bookmark['add_time']
         new_bookmark = {
             'title': bookmark['title'],
-            'index': len(archive_children),
-            'dateAdded': bookmark['add_time'],
-            'lastModified': bookmark['add_time'],
+            'index': index,
+            'dateAdded': add_time,
+            'lastModified': add_time,
             'type': 'text/x-moz-place',
             'uri': bookmark['url'],
             }
         # description
-        if bookmark['description']:
-            new_bookmark['annos'] = bj_create_bookmark_description(bookmark['description'])
+        description = bookmark['description']
+        if description:
+            new_bookmark['annos'] = [{**self._description_anno, 'value': description}]
         # tags
-        all_tags = []
-        if bookmark['tags']:
-            all_tags.extend(bookmark['tags'])
-        if meta_data['common_tags']:
-            all_tags.extend(meta_data['common_tags'])
-        if all_tags:
-            all_tags = set(all_tags) # Ensure that each tag is unique.
-            new_bookmark['tags'] = ','.join(all_tags)
-        # Add new bookmark.
-        archive_children.append(new_bookmark)
-    # Save bookmarks.
-    with open(output_name, 'w', encoding='UTF-8') as output_file:
-        json.dump(bookmarks_json, output_file)
+        own_tags = bookmark['tags']
+        if own_tags:
+            new_bookmark['tags'] = ','.join(dict.fromkeys(itertools.chain(own_tags, self._common_tags)))
+        elif self._common_tags_text:
+            new_bookmark['tags'] = self._common_tags_text
+        return new_bookmark
+
+def bj_append_bookmarks(container, bookmarks, meta_data):
+    """Append the bookmarks imported from NicoFox database to the container."""
+    children = container['children']
+    create = BookmarkTemplate(meta_data).create
+    append = children.append
+    for index, bookmark in enumerate(bookmarks, len(children)):
+        append(create(bookmark, index))
+    return len(children)
+
+def _encode_bookmarks_chunk(task):
+    """Worker of encode_bookmarks_parallel(), encode a chunk of bookmarks as JSON array items."""
+    bookmarks, start_index, meta_data = task
+    create = BookmarkTemplate(meta_data).create
+    dumps = json_backend.dumps
+    return ', '.join(dumps(create(bookmark, index)) for index, bookmark in enumerate(bookmarks, start_index))
+
+def encode_bookmarks_parallel(groups, meta_data, jobs=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    """Encode groups of bookmarks in worker processes.
+
+    Each group is a list of bookmarks whose indices start from 0. Return one string per group which
+    contains the comma-separated JSON items of the group, ready to be put between the array brackets.
+    The chunks are encoded exactly as the serializer does, so the concatenated output is the same.
+    """
+    tasks = []
+    owners = []
+    for group_number, bookmarks in enumerate(groups):
+        for start in range(0, len(bookmarks), chunk_size):
+            tasks.append((bookmarks[start:start + chunk_size], start, meta_data))
+            owners.append(group_number)
+    if len(tasks) > 1 and jobs != 1:
+        import concurrent.futures # Only parallel runs pay for importing it (and logging).
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            fragments = list(executor.map(_encode_bookmarks_chunk, tasks))
+    else:
+        fragments = [_encode_bookmarks_chunk(task) for task in tasks]
+    encoded_groups = [[] for _ in groups]
+    for group_number, fragment in zip(owners, fragments):
+        encoded_groups[group_number].append(fragment)
+    return [', '.join(encoded) for encoded in encoded_groups]
+
+class Porter:
+    """Load a bookmarks backup once, apply any number of ports to it and save it once.
+
+    Usage:
+        porter = Porter('bookmarks.json')
+        porter.add_container(import_nicofox_db('a.sqlite'), meta_data_a)
+        porter.add_container(import_nicofox_db('b.sqlite'), meta_data_b)
+        porter.save('output.json')
+
+    If jobs is not 1, new bookmarks are encoded to JSON by that many worker processes (None means
+    the number of CPUs) as soon as they are added. They are then kept as encoded text until saved,
+    so their containers hold a placeholder instead of the bookmark items in bookmarks_json.
+
+    If max_memory (in bytes) is given, the backup and the bookmarks which do not fit it are spilled
+    to a temporary store (see spilling.py) and streamed back by save(). When the backup is spilled,
+    only root and its direct children (menu, toolbar, etc.) are loaded and can be the parent of new
+    containers. Call close() or use the porter as a context manager to remove the temporary store.
+    """
+
+    def __init__(self, json_name, compact=False, jobs=1, max_memory=None):
+        self._jobs = jobs
+        self._placeholder_prefix = 'nicofox2bookmarks-encoded-{}-'.format(os.urandom(16).hex())
+        self._placeholders = {} # placeholder -> encoded children, or function to write them.
+        self._spilled_counts = {} # placeholder -> number of items, for the items of the spilled backup.
+        self._spill_store = None
+        self._memory_left = max_memory
+        if max_memory is not None:
+            import spilling
+            self._spill_store = spilling.SpillStore()
+        try:
+            if max_memory is not None:
+                tree_memory = spilling.estimate_tree_memory(json_name)
+                if tree_memory > max_memory:
+                    self._bookmarks_json, spilled, self._spilled_counts = self._spill_store.load_tree(json_name)
+                    self._placeholders.update(spilled)
+                else:
+                    self._bookmarks_json = bj_load(json_name, compact)
+                    self._memory_left -= tree_memory
+            else:
+                self._bookmarks_json = bj_load(json_name, compact)
+            if self._bookmarks_json.get('guid') != 'root________':
+                raise ValueError('The bookmarks backup does not start from the root node.')
+            self._guid_index = bj_build_guid_index(self._bookmarks_json)
+        except BaseException:
+            self.close() # __exit__() is never called when the constructor fails.
+            raise
+
+    def close(self):
+        """Remove the temporary store of spilled data."""
+        if self._spill_store is not None:
+            self._spill_store.close()
+            self._spill_store = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def bookmarks_json(self):
+        """The loaded (and modified) bookmarks tree.
+
+        The 'children' of containers whose items are spilled or encoded hold placeholder strings.
+        """
+        return self._bookmarks_json
+
+    def get_node_by_guid(self, guid):
+        """Return the node with specific GUID, or None if there is no such node."""
+        return self._guid_index.get(guid)
+
+    def add_container(self, bookmarks, meta_data, parent_guid='menu________'):
+        """Create a container under the parent node and fill it with the bookmarks.
+
+        The bookmarks can be any iterable of bookmark data. Return the created container.
+        """
+        parent = self._guid_index.get(parent_guid)
+        if parent is None:
+            raise ValueError('Can not find the parent container with GUID {!r}.'.format(parent_guid))
+        container_data = {
+            'title': meta_data['container'],
+            'description': meta_data['description']}
+        if self._spilled_counts:
+            # A placeholder of the spilled backup stands for all the items it replaces.
+            container_data['index'] = sum(self._spilled_counts.get(item, 1) if isinstance(item, str) else 1
+                                          for item in parent.get('children', ()))
+        container = bj_create_child_container(parent, container_data)
+        spilled = False
+        if self._spill_store is not None:
+            import spilling
+            bookmarks = self._spill_store.collect_bookmarks(bookmarks, self._memory_left)
+            spilled = isinstance(bookmarks, spilling.SpilledBookmarks)
+            if not spilled:
+                self._memory_left -= sum(spilling.estimate_bookmark_memory(bookmark) for bookmark in bookmarks)
+        shard = meta_data.get('shard')
+        if shard:
+            targets = []
+            for title, bucket in shard_bookmarks(bookmarks, shard):
+                earliest = min(bookmark['add_time'] for bookmark in bucket)
+                subfolder = bj_create_child_container(container, {
+                    'title': title,
+                    'dateAdded': earliest,
+                    'lastModified': earliest})
+                targets.append((subfolder, bucket))
+        else:
+            targets = [(container, bookmarks)]
+        if spilled:
+            # Spilled bookmarks are encoded one by one while saving.
+            for target, target_bookmarks in targets:
+                self._set_placeholder(target, functools.partial(
+                    _write_spilled_bookmarks, target_bookmarks, meta_data))
+        elif self._jobs == 1:
+            for target, target_bookmarks in targets:
+                bj_append_bookmarks(target, target_bookmarks, meta_data)
+        else:
+            groups = [list(target_bookmarks) for _, target_bookmarks in targets]
+            encoded_groups = encode_bookmarks_parallel(groups, meta_data, self._jobs)
+            for (target, _), encoded in zip(targets, encoded_groups):
+                self._set_placeholder(target, encoded)
+        return container
+
+    def _set_placeholder(self, container, content):
+        placeholder = self._placeholder_prefix + str(len(self._placeholders))
+        self._placeholders[placeholder] = content
+        container['children'] = [placeholder]
+
+    def save(self, output_name):
+        """Serialize the bookmarks tree to the output file."""
+        if self._spill_store is not None:
+            import spilling
+            # Stream the output instead of building it in memory.
+            with open(output_name, 'w', encoding='UTF-8') as output_file:
+                spilling.write_tree(self._bookmarks_json, output_file.write, self._placeholders)
+            return
+        if not self._placeholders:
+            with open(output_name, 'w', encoding='UTF-8') as output_file:
+                json_backend.dump(self._bookmarks_json, output_file)
+            return
+        # Serialize once and write the encoded children where their placeholders are.
+        data = json_backend.dumps(self._bookmarks_json)
+        placeholder_re = re.compile('"({}[0-9]+)"'.format(re.escape(self._placeholder_prefix)))
+        with open(output_name, 'w', encoding='UTF-8') as output_file:
+            last = 0
+            for match in placeholder_re.finditer(data):
+                output_file.write(data[last:match.start()])
+                output_file.write(self._placeholders[match.group(1)])
+                last = match.end()
+            output_file.write(data[last:])
+
+def _write_spilled_bookmarks(bookmarks, meta_data, write):
+    create = BookmarkTemplate(meta_data).create
+    for index, bookmark in enumerate(bookmarks):
+        if index:
+            write(', ')
+        write(json_backend.dumps(create(bookmark, index)))
+
+def export_bookmarks_to_json(output_name, json_name, bookmarks, meta_data, compact=False, jobs=1, max_memory=None):
+    """Export the bookmarks imported from NicoFox database to Firefox bookmarks JSON file."""
+    with Porter(json_name, compact, jobs, max_memory) as porter:
+        porter.add_container(bookmarks, meta_data)
+        porter.save(output_name)
 
 def parse_arguments(args=None):
     """Setup and parse program arguments."""
-    parser = argparse.ArgumentParser()
+    import argparse
+
+    class _HelpFormatter(argparse.HelpFormatter):
+        # The registered jsonlz4 backends are only looked up when the help is shown.
+        def _get_help_string(self, action):
+            if action.dest == 'jsonlz4_backend':
+                import jsonlz4_decoder
+                return action.help.format(', '.join(jsonlz4_decoder.get_registered_backends()))
+            return action.help
+
+    parser = argparse.ArgumentParser(formatter_class=_HelpFormatter)
     parser.add_argument('-n', '--nicofox', help='The name of NicoFox database file, usually named "smilefox.sqlite". (input file)')
     parser.add_argument('-b', '--bookmarks', help='The name of Firefox bookmarks file, usually named "bookmarks-yyyy-mm-dd.json". (input file)')
     parser.add_argument('-o', '--output', help='The name of result bookmarks file with NicoFox\'s list in. (output file)')
     parser.add_argument('-c', '--container', help='The name of the folder which the new bookmarks contain.')
     parser.add_argument('-d', '--container-desc', help='The description of the folder which the new bookmarks contain.')
     parser.add_argument('-t', '--common-tags', help='The tag(s) added to all new bookmarks.')
-    return parser.parse_args(args)
+    parser.add_argument('-s', '--shard', type=parse_shard, help='Split the new bookmarks into subfolders by "year", "month" or a fixed size (number of bookmarks).')
+    parser.add_argument('--since', type=parse_filter_time, help='Only port the items added since this local date/time, like "2017-09-03".')
+    parser.add_argument('--until', type=parse_filter_time, help='Only port the items added before this local date/time, like "2017-09-03".')
+    parser.add_argument('--url', help='Only port the items whose URL starts with this prefix, or matches this glob pattern if it contains "*", "?" or "[".')
+    parser.add_argument('--title', help='Only port the items whose title contains this text.')
+    parser.add_argument('--limit', type=int, help='Port at most this number of items.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='The number of worker processes to encode new bookmarks, 0 means the number of CPUs.')
+    parser.add_argument('-m', '--max-memory', type=parse_memory_size, help='The memory budget like "512M", data which exceeds it is spilled to temporary files.')
+    parser.add_argument('--estimate', '--dry-run', dest='estimate', action='store_true', help='Only inspect the inputs and estimate the output size and duration.')
+    parser.add_argument('--compact', action='store_true', help='Share repeated values while loading the bookmarks to reduce memory usage.')
+    backend_group = parser.add_mutually_exclusive_group()
+    backend_group.add_argument('--jsonlz4-backend', help='The backend to decompress jsonlz4 bookmarks: {}.')
+    backend_group.add_argument('--auto-benchmark', action='store_true', help='Benchmark the jsonlz4 backends, use and remember the fastest one.')
+    arguments = parser.parse_args(args)
+    if arguments.jsonlz4_backend:
+        import jsonlz4_decoder
+        try:
+            jsonlz4_decoder.check_backend(arguments.jsonlz4_backend)
+        except ValueError as ex:
+            parser.error('argument --jsonlz4-backend: {}'.format(ex))
+    return arguments
 
 def main():
     """Main function."""
@@ -170,10 +707,23 @@ def main():
         else 'Bookmarks imported from NicoFox database using {}.'.format(__title__)
     if arguments.common_tags:
         meta_data['common_tags'] = [tag.strip() for tag in arguments.common_tags.split(',') if tag.strip()]
+    meta_data['shard'] = arguments.shard
+
+    # Collect filters from program arguments.
+    filters = create_filters()
+    filters['since'] = arguments.since
+    filters['until'] = arguments.until
+    if arguments.url:
+        parse_url_filter(filters, arguments.url)
+    filters['title_contains'] = arguments.title or None
+    filters['limit'] = arguments.limit
 
     # Setup input and output filenames from program arguments.
     nicofox_database = arguments.nicofox or 'smilefox.sqlite'
-    bookmarks_file = arguments.bookmarks or firefox_helper.get_bookmarks_backup_filename()
+    bookmarks_file = arguments.bookmarks
+    if not bookmarks_file:
+        import firefox_helper
+        bookmarks_file = firefox_helper.get_bookmarks_backup_filename()
     output_file = arguments.output or 'bookmarks-output.json'
 
     # Display basic information.
@@ -186,13 +736,45 @@ def main():
     print()
 
     # Check the input and output filenames.
-    if not pathlib.Path(nicofox_database).is_file():
+    if not os.path.isfile(nicofox_database):
         print('Error: the NicoFox database file does not exist or not specified.')
         return
-    if not pathlib.Path(bookmarks_file).is_file():
+    if not os.path.isfile(bookmarks_file):
         print('Error: the Firefox bookmarks file does not exist or not specified.')
         return
-    if pathlib.Path(output_file).is_file():
+    if arguments.jsonlz4_backend or arguments.auto_benchmark or bookmarks_file.lower().endswith('.jsonlz4'):
+        import jsonlz4_decoder
+        backend_from_env = os.getenv(jsonlz4_decoder.BACKEND_ENV_VAR)
+        if arguments.jsonlz4_backend:
+            jsonlz4_decoder.select_backend(arguments.jsonlz4_backend)
+        elif arguments.auto_benchmark:
+            jsonlz4_decoder.auto_select_backend()
+        elif backend_from_env:
+            # Check it before porting, like --jsonlz4-backend.
+            try:
+                jsonlz4_decoder.check_backend(backend_from_env)
+            except ValueError as ex:
+                print('Error: environment variable {}: {}'.format(jsonlz4_decoder.BACKEND_ENV_VAR, ex))
+                return
+    if arguments.estimate:
+        estimate = estimate_port(nicofox_database, bookmarks_file, meta_data, filters,
+            arguments.jobs or None, arguments.max_memory)
+        print('NicoFox items: {} ({} with description)'.format(estimate['rows'], estimate['described_rows']))
+        if estimate['rows']:
+            print('Added from {:%Y-%m-%d %H:%M} to {:%Y-%m-%d %H:%M}'.format(
+                bookmark_time_to_datetime(estimate['first_add_time']),
+                bookmark_time_to_datetime(estimate['last_add_time'])))
+        if estimate['subfolders']:
+            print('Subfolders: {}'.format(estimate['subfolders']))
+        print('Bookmarks backup size: {} bytes'.format(estimate['backup_size']))
+        if estimate['spill_backup']:
+            print('The bookmarks backup exceeds the memory budget and will be spilled to disk.')
+        if estimate['spill_bookmarks']:
+            print('The new bookmarks exceed the memory budget and will be spilled to disk.')
+        print('Estimated output size: {} bytes'.format(estimate['output_size']))
+        print('Estimated duration: {} ms'.format(estimate['duration_ms']))
+        return
+    if os.path.isfile(output_file):
         overwrite = input('The output file seems have already exist. Overwrite it? ')
         if overwrite.lower() not in ('y', 'yes'):
             print('Operation canceled.')
@@ -202,11 +784,17 @@ def main():
     # Port data.
     try:
         print('Importing data from NicoFox database...')
-        bookmarks = import_nicofox_db(nicofox_database)
-        if bookmarks:
+        if arguments.max_memory is None:
+            bookmarks = import_nicofox_db(nicofox_database, filters)
+            bookmarks_count = len(bookmarks)
+        else:
+            bookmarks = iter_nicofox_db(nicofox_database, filters) # Let the porter decide whether to spill them.
+            bookmarks_count = count_nicofox_db(nicofox_database, filters)
+        if bookmarks_count:
             print('Exporting data to bookmarks...')
-            export_bookmarks_to_json(output_file, bookmarks_file, bookmarks, meta_data)
-            print('Successful! {} bookmark(s) are ported.'.format(len(bookmarks)))
+            export_bookmarks_to_json(output_file, bookmarks_file, bookmarks, meta_data,
+                arguments.compact, arguments.jobs or None, arguments.max_memory)
+            print('Successful! {} bookmark(s) are ported.'.format(bookmarks_count))
         else:
             print('No data to port.')
     except Exception:
@@ -85,8 +85,9 @@ def _porting_task(param, on_exit):
         bookmark_path = param['bookmark_path']
         output_path = param['output_path']
         metadata = param['metadata']
+        filters = param['filters']
 
-        bookmarks = nicofox2bookmarks.import_nicofox_db(str(nicofox_path))
+        bookmarks = nicofox2bookmarks.import_nicofox_db(str(nicofox_path), filters)
         if bookmarks:
             nicofox2bookmarks.export_bookmarks_to_json(str(output_path), str(bookmark_path), bookmarks, metadata)
             tk.messagebox.showinfo(__title__, _('Successful! {} bookmark(s) are ported.').format(len(bookmarks)))
@@ -280,6 +281,11 @@ class MetaPanel(tk.Frame):
         self._container_entry = self._create_field(_('Container:'), next(row_counter))
         self._container_desc_entry = self._create_field(_('Container Description:'), next(row_counter))
         self._common_tags_entry = self._create_field(_('Common Tags:'), next(row_counter))
+        self._since_entry = self._create_field(_('Added Since:'), next(row_counter))
+        self._until_entry = self._create_field(_('Added Before:'), next(row_counter))
+        self._url_entry = self._create_field(_('URL Prefix or Pattern:'), next(row_counter))
+        self._title_entry = self._create_field(_('Title Contains:'), next(row_counter))
+        self._limit_entry = self._create_field(_('Limit:'), next(row_counter))
         self.columnconfigure(1, weight=1)
         _pad_widget_children_grid(self)
 
@@ -318,6 +324,23 @@ class MetaPanel(tk.Frame):
         self._common_tags_entry.delete(0, tk.END)
         self._common_tags_entry.insert(0, tags_text)
 
+    @property
+    def filters(self):
+        """The filters for importing NicoFox database, raise ValueError if any of them is invalid."""
+        filters = nicofox2bookmarks.create_filters()
+        since_text = self._since_entry.get().strip()
+        if since_text:
+            filters['since'] = nicofox2bookmarks.parse_filter_time(since_text)
+        until_text = self._until_entry.get().strip()
+        if until_text:
+            filters['until'] = nicofox2bookmarks.parse_filter_time(until_text)
+        nicofox2bookmarks.parse_url_filter(filters, self._url_entry.get())
+        filters['title_contains'] = self._title_entry.get().strip() or None
+        limit_text = self._limit_entry.get().strip()
+        if limit_text:
+            filters['limit'] = int(limit_text)
+        return filters
+
 class Processor:
     """Collect data from UI and launch porting tasks."""
 
@@ -463,6 +486,11 @@ class Processor:
         metadata['description'] = self._meta_source.container_description\
             or _('Bookmarks imported from NicoFox database using {}.').format(__title__)
         metadata['common_tags'] = self._meta_source.common_tags
+        try:
+            filters = self._meta_source.filters
+        except ValueError as ex:
+            tk.messagebox.showwarning(__title__, _('Invalid filter:\n{}').format(ex))
+            return
         # Feedback the correct metadata to UI.
         self._meta_source.container = metadata['container']
         self._meta_source.container_description = metadata['description']
@@ -473,6 +501,7 @@ class Processor:
             'bookmark_path': bookmark_path,
             'output_path': output_path,
             'metadata': metadata,
+            'filters': filters,
             }
         if len(self._tasks) >= 8:
             self._clear_finished_tasks()
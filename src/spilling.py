@@ -0,0 +1,315 @@
+# -*- coding: UTF-8 -*-
+"""spilling.py
+
+Disk spilling for porting under a memory limit.
+Bookmarks and untouched subtrees of the bookmarks backup which do not fit the memory budget are
+kept in a temporary directory (a scratch SQLite database and the decompressed backup), and are
+streamed back while writing the output.
+"""
+import codecs
+import functools
+import itertools
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+
+import json_backend
+import jsonlz4_decoder
+
+# Rough memory usage, measured on CPython 3.11 (64-bit).
+TREE_MEMORY_FACTOR = 6 # Loading and parsing the bookmarks tree, per byte of JSON text.
+BOOKMARK_MEMORY_OVERHEAD = 512 # Bookmark data dictionary besides its strings.
+
+_MEMORY_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+_MEMORY_SIZE_RE = re.compile(r'^\s*(\d+)\s*([KMGT]?)(?:I?B)?\s*$', re.IGNORECASE)
+_COPY_CHUNK_SIZE = 0x100000
+_SPILL_BATCH_SIZE = 1000
+_SPILL_DEPTH = 2 # Items in the children of root's children (menu, toolbar, etc.) are spilled.
+# Strings (with the colon after keys) and brackets. A lone quote is a string cut at the end of a chunk.
+_TOKEN_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"(\s*:)?|"|[\[\]{}]', re.DOTALL)
+_CHILDREN_KEY = b'"children"'
+_shard_table_numbers = itertools.count()
+
+def parse_memory_size(text):
+    """Parse memory size like "512M" or "2GiB" and return it in bytes."""
+    match = _MEMORY_SIZE_RE.match(text)
+    if match is None:
+        raise ValueError('invalid memory size: {!r}.'.format(text))
+    return int(match.group(1)) * _MEMORY_UNITS[match.group(2).upper()]
+
+def estimate_bookmark_memory(bookmark):
+    """Estimate the memory used by a bookmark data dictionary."""
+    text_length = len(bookmark['title'] or '') + len(bookmark['url'] or '') + len(bookmark['description'] or '')
+    return BOOKMARK_MEMORY_OVERHEAD + 2 * text_length
+
+def get_json_text_size(json_name):
+    """Return the size of the JSON text of a bookmarks backup without decompressing it."""
+    if json_name.lower().endswith('.jsonlz4'):
+        with open(json_name, 'rb') as bookmarks_json_file:
+            return jsonlz4_decoder.read_decompressed_size(bookmarks_json_file)
+    return os.path.getsize(json_name)
+
+def estimate_tree_memory(json_name):
+    """Estimate the memory used by the parsed tree of a bookmarks backup."""
+    return get_json_text_size(json_name) * TREE_MEMORY_FACTOR
+
+def _scan_spillable_spans(file):
+    """Return the (start, end, number of items) of the item runs in the 'children' arrays of nodes at _SPILL_DEPTH.
+
+    The file is read chunk by chunk. Each run spans all the items of an array (and the separators between
+    them), so the memory used depends neither on the size of the file nor on the number of spilled items.
+    """
+    spans = []
+    stack = [] # 'o' for object, 'a' for array, 's' for array whose items are spilled.
+    objects = 0
+    is_children_key = False
+    item_start = None
+    item_level = 0
+    run_start = run_end = None
+    run_items = 0
+    offset = 0 # Offset of the buffer in the file.
+    buffer = b''
+    while True:
+        data = file.read(_COPY_CHUNK_SIZE)
+        buffer += data
+        # A string at the end of the buffer may be cut, or be a key whose colon is not read yet.
+        complete_end = len(buffer.rstrip()) if data else len(buffer) + 1
+        rest = len(buffer)
+        for match in _TOKEN_RE.finditer(buffer):
+            token = match.group()
+            first = token[:1]
+            if first == b'"':
+                if data and (len(token) == 1 or match.end() >= complete_end):
+                    rest = match.start()
+                    break
+                is_children_key = match.group(1) is not None and token.startswith(_CHILDREN_KEY)
+                continue
+            if first == b'{':
+                if item_start is None and stack and stack[-1] == 's':
+                    item_start = offset + match.start()
+                    item_level = len(stack)
+                stack.append('o')
+                objects += 1
+            elif first == b'[':
+                if item_start is None and is_children_key and objects == _SPILL_DEPTH and stack[-1] == 'o':
+                    stack.append('s')
+                else:
+                    stack.append('a')
+            else:
+                kind = stack.pop()
+                if kind == 'o':
+                    objects -= 1
+                elif kind == 's' and run_items:
+                    spans.append((run_start, run_end, run_items))
+                    run_items = 0
+                if item_start is not None and len(stack) == item_level:
+                    if not run_items:
+                        run_start = item_start
+                    run_end = offset + match.end()
+                    run_items += 1
+                    item_start = None
+            is_children_key = False
+        if not data:
+            return spans
+        buffer = buffer[rest:]
+        offset += rest
+
+def _copy_span(file, start, end, write):
+    decoder = codecs.getincrementaldecoder('UTF-8')()
+    file.seek(start)
+    for position in range(start, end, _COPY_CHUNK_SIZE):
+        write(decoder.decode(file.read(min(_COPY_CHUNK_SIZE, end - position))))
+    write(decoder.decode(b'', final=True))
+
+def write_tree(node, write, placeholders):
+    """Write the tree as json.dump() does, and write the content of placeholders in 'children' instead.
+
+    A placeholder's content is either the text to write or a function which takes the write function.
+    """
+    if 'children' not in node:
+        write(json_backend.dumps(node))
+        return
+    write('{')
+    for number, (key, value) in enumerate(node.items()):
+        if number:
+            write(', ')
+        write(json.dumps(key))
+        write(': ')
+        if key != 'children':
+            write(json_backend.dumps(value))
+            continue
+        write('[')
+        for item_number, item in enumerate(value):
+            if item_number:
+                write(', ')
+            if isinstance(item, str):
+                content = placeholders[item]
+                if isinstance(content, str):
+                    write(content)
+                else:
+                    content(write)
+            else:
+                write_tree(item, write, placeholders)
+        write(']')
+    write('}')
+
+class SpilledBookmarks:
+    """Bookmarks kept in the scratch database, iterated in their original order."""
+
+    def __init__(self, database, condition, parameters):
+        self._database = database
+        self._condition = condition
+        self._parameters = parameters
+
+    def __len__(self):
+        query = 'SELECT COUNT(*) FROM bookmarks WHERE {};'.format(self._condition)
+        return self._database.execute(query, self._parameters).fetchone()[0]
+
+    def __iter__(self):
+        query = 'SELECT title, url, description, tags, add_time FROM bookmarks WHERE {} ORDER BY seq;'.format(
+            self._condition)
+        for title, url, description, tags, add_time in self._database.execute(query, self._parameters):
+            yield {
+                'title': title,
+                'url': url,
+                'description': description,
+                'tags': json.loads(tags) if tags is not None else None,
+                'add_time': add_time,
+                }
+
+    def shard_by_size(self, size):
+        """Split into buckets of fixed size, return a list of (title, bookmarks) like shard_bookmarks()."""
+        query = 'SELECT MIN(seq), MAX(seq) FROM bookmarks WHERE {};'.format(self._condition)
+        first, last = self._database.execute(query, self._parameters).fetchone()
+        if first is None:
+            return []
+        buckets = []
+        for start in range(first, last + 1, size):
+            end = min(start + size - 1, last)
+            buckets.append(('{}-{}'.format(start - first + 1, end - first + 1), SpilledBookmarks(
+                self._database,
+                '({}) AND seq BETWEEN ? AND ?'.format(self._condition),
+                tuple(self._parameters) + (start, end))))
+        return buckets
+
+    def shard_by_date(self, title_format):
+        """Split into buckets by add_time (local time), return a sorted list of (title, bookmarks)."""
+        # Local time can not be indexed, so the buckets are computed once into an indexed table.
+        table = 'shard_{}'.format(next(_shard_table_numbers))
+        self._database.execute('CREATE TABLE {} (title TEXT, seq INTEGER, PRIMARY KEY (title, seq)) WITHOUT ROWID;'.format(
+            table))
+        self._database.execute(
+            "INSERT INTO {} SELECT strftime(?, add_time / 1000000, 'unixepoch', 'localtime'), seq"
+            " FROM bookmarks WHERE {};".format(table, self._condition),
+            (title_format,) + tuple(self._parameters))
+        self._database.commit()
+        query = 'SELECT DISTINCT title FROM {} ORDER BY title;'.format(table)
+        titles = [row[0] for row in self._database.execute(query)]
+        return [(title, SpilledBookmarks(
+            self._database,
+            'seq IN (SELECT seq FROM {} WHERE title = ?)'.format(table),
+            (title,))) for title in titles]
+
+class SpillStore:
+    """Temporary on-disk store for the data which does not fit the memory budget.
+
+    Usage:
+        with SpillStore() as store:
+            tree, placeholders, item_counts = store.load_tree('bookmarks.jsonlz4')
+            bookmarks = store.collect_bookmarks(iter_nicofox_db('smilefox.sqlite'), budget)
+            ...
+    """
+
+    def __init__(self):
+        self._directory = tempfile.mkdtemp(prefix='nicofox2bookmarks-')
+        try:
+            self._database = sqlite3.connect(os.path.join(self._directory, 'scratch.sqlite'))
+            self._database.execute('CREATE TABLE bookmarks ('
+                                   'seq INTEGER PRIMARY KEY, batch INTEGER, '
+                                   'title TEXT, url TEXT, description TEXT, tags TEXT, add_time INTEGER);')
+        except BaseException:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            raise
+        self._batches = itertools.count()
+        self._placeholder_prefix = 'nicofox2bookmarks-spilled-{}-'.format(os.urandom(16).hex())
+        self._open_files = []
+
+    def close(self):
+        """Close and remove all the spilled data."""
+        self._database.close()
+        for file in self._open_files:
+            file.close()
+        self._open_files.clear()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def spill_bookmarks(self, bookmarks):
+        """Move the bookmarks to the scratch database and return them as SpilledBookmarks."""
+        batch = next(self._batches)
+        iterator = iter(bookmarks)
+        while True:
+            rows = [(batch, bookmark['title'], bookmark['url'], bookmark['description'],
+                     json.dumps(bookmark['tags']) if bookmark['tags'] is not None else None, bookmark['add_time'])
+                    for bookmark in itertools.islice(iterator, _SPILL_BATCH_SIZE)]
+            if not rows:
+                break
+            self._database.executemany(
+                'INSERT INTO bookmarks (batch, title, url, description, tags, add_time) VALUES (?, ?, ?, ?, ?, ?);',
+                rows)
+        self._database.commit()
+        return SpilledBookmarks(self._database, 'batch = ?', (batch,))
+
+    def collect_bookmarks(self, bookmarks, budget):
+        """Collect the bookmarks in a list, or spill them all if they exceed the memory budget."""
+        if isinstance(bookmarks, SpilledBookmarks):
+            return bookmarks
+        collected = []
+        used = 0
+        iterator = iter(bookmarks)
+        for bookmark in iterator:
+            collected.append(bookmark)
+            used += estimate_bookmark_memory(bookmark)
+            if used > budget:
+                return self.spill_bookmarks(itertools.chain(collected, iterator))
+        return collected
+
+    def load_tree(self, json_name):
+        """Load the bookmarks backup with the items of top-level containers left on disk.
+
+        Return the tree, a dictionary of placeholders for write_tree() and a dictionary of placeholder ->
+        number of items. The spilled items of a container are replaced by one placeholder string in its
+        'children', so the numbers are needed to compute the indices of new items.
+        """
+        if json_name.lower().endswith('.jsonlz4'):
+            text_name = os.path.join(self._directory, 'bookmarks.json')
+            with open(json_name, 'rb') as input_file, open(text_name, 'wb') as output_file:
+                chunks = iter(lambda: input_file.read(_COPY_CHUNK_SIZE), b'')
+                for data in jsonlz4_decoder.iter_decompress_jsonlz4(chunks):
+                    output_file.write(data)
+        else:
+            text_name = json_name
+        file = open(text_name, 'rb')
+        self._open_files.append(file)
+        placeholders = {}
+        item_counts = {}
+        skeleton = []
+        last = 0
+        for start, end, items in _scan_spillable_spans(file):
+            placeholder = self._placeholder_prefix + str(len(placeholders))
+            placeholders[placeholder] = functools.partial(_copy_span, file, start, end)
+            item_counts[placeholder] = items
+            file.seek(last)
+            skeleton.append(file.read(start - last))
+            skeleton.append(json.dumps(placeholder).encode('UTF-8'))
+            last = end
+        file.seek(last)
+        skeleton.append(file.read())
+        return json.loads(b''.join(skeleton).decode('UTF-8')), placeholders, item_counts